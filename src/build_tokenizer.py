@@ -1,10 +1,10 @@
 import argparse
 import os
 import json
+import hashlib
+import functools
 from typing import Optional, List
 
-from tokenizers import ByteLevelBPETokenizer
-
 import lib_logging
 from lib_path import LocalPath
 
@@ -70,9 +70,22 @@ class TokenizerConfig:
                 indent=4,
             )
 
+    def get_hash(self) -> str:
+        """ Compute a hash which identifies the tokenizer's vocabulary and merges. If the tokenizer is rebuilt with different parameters the hash will change.
+        Returns: Hex encoded SHA-256 digest of the vocab_file and merges_file contents
+        """
+        digest = hashlib.sha256()
+
+        for tokenizer_file in [self.vocab_file, self.merges_file]:
+            with open(tokenizer_file.get_absolute_path(), 'rb') as tokenizer_f:
+                digest.update(tokenizer_f.read())
+
+        return digest.hexdigest()
+
     @staticmethod
+    @functools.lru_cache(maxsize=8)
     def load(load_path: LocalPath) -> 'TokenizerConfig':
-        """ Loads a TokenizerConfig from a file.
+        """ Loads a TokenizerConfig from a file. Results are cached, so repeated loads of the same file return the same TokenizerConfig.
         Arguments:
         - load_path: Path from which to load config
 
@@ -183,6 +196,9 @@ def train_tokenizer(
     - sample_start_token: Token used to delineate the start of a sample
     - sample_end_token: Token used to delineate the end of a sample
     """
+    # Imported here so modules which only need TokenizerConfig don't load tokenizers
+    from tokenizers import ByteLevelBPETokenizer
+
     tokenizer = ByteLevelBPETokenizer(
         dropout=None,
         trim_offsets=True,
@@ -1,8 +1,13 @@
 import argparse
 import os
 import json
+import gzip
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain, islice
 from typing import Optional, List
 
+import numpy as np
+from tokenizers import Tokenizer
 from aitextgen.TokenDataset import TokenDataset
 
 import lib_logging
@@ -56,20 +61,128 @@ def encode_dataset(
     dataset_in: LocalPath,
     dataset_out: LocalPath,
     tokenizer_config: TokenizerConfig,
-):
+) -> TokenDataset:
     """ Given a dataset encodes the contents using the tokenizer. Saves the results.
     Arguments:
     - dataset_in: Path to the un-encoded dataset file
     - dataset_out: Path where the encoded dataset will be saved
     - tokenizer_config: Information about the tokenizer
+
+    Returns: The encoded dataset
+    """
+    return encode_dataset_batches(
+        dataset_in=dataset_in,
+        dataset_out=dataset_out,
+        tokenizer_config=tokenizer_config,
+    )
+
+def start_encode_dataset(
+    dataset_in: LocalPath,
+    dataset_out: LocalPath,
+    tokenizer_config: TokenizerConfig,
+) -> 'Future[TokenDataset]':
+    """ Start encoding a dataset in a background thread.
+    Arguments:
+    - dataset_in: Path to the un-encoded dataset file
+    - dataset_out: Path where the encoded dataset will be saved
+    - tokenizer_config: Information about the tokenizer
+
+    Returns: Future which resolves to the encoded dataset once it has been encoded and saved
+    """
+    encode_pool = ThreadPoolExecutor(max_workers=1)
+    data_future = encode_pool.submit(
+        encode_dataset_batches,
+        dataset_in=dataset_in,
+        dataset_out=dataset_out,
+        tokenizer_config=tokenizer_config,
+    )
+    encode_pool.shutdown(wait=False)
+
+    return data_future
+
+def encode_dataset_batches(
+    dataset_in: LocalPath,
+    dataset_out: LocalPath,
+    tokenizer_config: TokenizerConfig,
+    batch_size: int=10_000,
+) -> TokenDataset:
+    """ Encode a dataset in batches of lines. The tokenizers library encodes each batch in parallel on all CPUs without holding the GIL.
+    Arguments:
+    - dataset_in: Path to the un-encoded dataset file
+    - dataset_out: Path where the encoded dataset will be saved
+    - tokenizer_config: Information about the tokenizer
+    - batch_size: Number of lines encoded at once
+
+    Returns: The encoded dataset
+    """
+    tokenizer = Tokenizer.from_file(tokenizer_config.tokenizer_model_overview_file.get_absolute_path())
+
+    # Match the token type used by aitextgen's own TokenDataset caches
+    dtype = np.uint16 if tokenizer.get_vocab_size() < 2**16 else np.int32
+    batches = [ np.empty(0, dtype=dtype) ]
+
+    # Lines keep their newlines, like aitextgen's TokenDataset
+    with open(dataset_in.get_absolute_path(), 'r', encoding='utf-8', newline='\n') as dataset_f:
+        while True:
+            lines = list(islice(dataset_f, batch_size))
+            if len(lines) == 0:
+                break
+
+            encodings = tokenizer.encode_batch(lines, add_special_tokens=False)
+            batches.append(np.fromiter(
+                chain.from_iterable(encoding.ids for encoding in encodings),
+                dtype=dtype,
+            ))
+
+    tokens = np.concatenate(batches)
+
+    # Save in the same format as TokenDataset.save() so it can be loaded with from_cache
+    with gzip.open(dataset_out.get_absolute_path(), 'wb', compresslevel=3) as out_f:
+        np.save(out_f, tokens)
+
+    # Record which tokenizer encoded the dataset so stale caches can be detected
+    with open(get_tokenizer_hash_path(dataset_out).get_absolute_path(), 'w') as hash_f:
+        hash_f.write(tokenizer_config.get_hash())
+
+    logger.info(f"Encoded dataset '{dataset_in.get_project_relative_path()}' into '{dataset_out.get_project_relative_path()}'")
+
+    return load_encoded_dataset(
+        dataset_out=dataset_out,
+        tokenizer_config=tokenizer_config,
+    )
+
+def load_encoded_dataset(
+    dataset_out: LocalPath,
+    tokenizer_config: TokenizerConfig,
+) -> Optional[TokenDataset]:
+    """ Load a dataset previously saved by encode_dataset.
+    Arguments:
+    - dataset_out: Path where the encoded dataset was saved
+    - tokenizer_config: Information about the tokenizer which the dataset must have been encoded with
+
+    Returns: The encoded dataset, or None if it does not exist or was encoded with a different tokenizer
     """
-    TokenDataset(
-        file_path=dataset_in.get_absolute_path(),
-        vocab_file=tokenizer_config.vocab_file.get_absolute_path(),
-        merges_file=tokenizer_config.merges_file.get_absolute_path(),
-        save_cache=True,
-        cache_destination=dataset_out.get_absolute_path(),
+    hash_path = get_tokenizer_hash_path(dataset_out)
+
+    if not os.path.exists(dataset_out.get_absolute_path()) or not os.path.exists(hash_path.get_absolute_path()):
+        return None
+
+    with open(hash_path.get_absolute_path(), 'r') as hash_f:
+        if hash_f.read().strip() != tokenizer_config.get_hash():
+            logger.info(f"Encoded dataset '{dataset_out.get_project_relative_path()}' was made by a different tokenizer, it will be re-encoded")
+            return None
+
+    return TokenDataset(
+        file_path=dataset_out.get_absolute_path(),
+        from_cache=True,
     )
 
+def get_tokenizer_hash_path(dataset_out: LocalPath) -> LocalPath:
+    """ Returns: Path of the file which stores the hash of the tokenizer used to encode dataset_out.
+    Arguments:
+    - dataset_out: Path of the encoded dataset
+    """
+    return LocalPath(f"{dataset_out.get_project_relative_path()}.tokenizer-hash")
+
 if __name__ == '__main__':
     main()
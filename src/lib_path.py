@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Optional, Union
 import os
 from pathlib import PureWindowsPath, PurePosixPath
 
@@ -9,8 +9,10 @@ class LocalPath:
     """ Represents a file or directory path in the project directory.
     Fields:
     - __project_relative_path: Path represented relative to the project directory root
+    - __absolute_path: Path relative to the file system root, resolved the first time it is requested
     """
     __project_relative_path: str
+    __absolute_path: Optional[str]
 
     def __init__(self, parts: Union[List[str], str]):
         """ Initializes a LocalPath.
@@ -78,6 +80,7 @@ class LocalPath:
                 
         # Save relative path
         self.__project_relative_path = os.path.relpath(joined_parts, REPO_DIR)
+        self.__absolute_path = None
 
     def get_project_relative_path(self) -> str:
         """ Returns: Path relative to the project root directory.
@@ -87,7 +90,22 @@ class LocalPath:
     def get_absolute_path(self) -> str:
         """ Returns: Path relative to file system root.
         """
-        return os.path.realpath(self.get_project_relative_path())
+        # Resolving symbolic links requires file system calls, only do it once
+        if self.__absolute_path is None:
+            self.__absolute_path = os.path.realpath(self.get_project_relative_path())
+
+        return self.__absolute_path
+
+    def __eq__(self, other: object) -> bool:
+        """ Returns: True if other is a LocalPath which refers to the same path.
+        """
+        if not isinstance(other, LocalPath):
+            return NotImplemented
+
+        return self.get_project_relative_path() == other.get_project_relative_path()
+
+    def __hash__(self) -> int:
+        return hash(self.get_project_relative_path())
 
     def join(self, parts: List[str]) -> 'LocalPath':
         """ Constructs a new LocalPath with parts added onto the end.
@@ -0,0 +1,289 @@
+import os
+import sys
+import inspect
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader, Dataset
+from aitextgen.TokenDataset import TokenDataset
+from aitextgen import aitextgen
+from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+
+from lib_path import LocalPath
+
+# (major, minor) version of the installed PyTorch, some training optimizations need newer versions than the GPU setup's Anaconda environment provides
+TORCH_VERSION = tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
+
+def supports_torch_compile() -> bool:
+    """ Returns: True if torch.compile can be used, it needs PyTorch 2.1+ and isn't supported on Windows.
+    """
+    return TORCH_VERSION >= (2, 1) and sys.platform != 'win32'
+
+def supports_fused_attention() -> bool:
+    """ Returns: True if scaled_dot_product_attention with a custom scale is available, it needs PyTorch 2.1+.
+    """
+    return TORCH_VERSION >= (2, 1)
+
+def get_adamw_kernel_kwargs(gpu: bool) -> Optional[Dict[str, Any]]:
+    """ Determine which AdamW implementation to use, a fused kernel is used on GPUs which support it (PyTorch 2.0+ and compute capability 7+), otherwise parameters are updated in groups instead of one at a time (PyTorch 1.12+).
+    Arguments:
+    - gpu: If training will happen on a GPU
+
+    Returns: Keyword arguments for torch.optim.AdamW, or None if the installed PyTorch only has the default implementation
+    """
+    if gpu and TORCH_VERSION >= (2, 0) and torch.cuda.get_device_capability()[0] >= 7:
+        return { 'fused': True }
+    elif TORCH_VERSION >= (1, 12):
+        return { 'foreach': True }
+
+    return None
+
+class DeviceTokenDataset(Dataset):
+    """ Wraps a TokenDataset so its tokens are stored in device memory. Samples are views into the device tensor so no host to device copies are made during training.
+    Fields:
+    - data: Wrapped dataset, attributes not defined by DeviceTokenDataset are read from it
+    - tokens: All tokens of the dataset on the device
+    """
+    data: TokenDataset
+    tokens: torch.Tensor
+
+    def __init__(self, data: TokenDataset, device: str):
+        """ Initializes a DeviceTokenDataset.
+        Arguments:
+        - data: See DeviceTokenDataset.data
+        - device: Torch device to which tokens will be copied
+        """
+        self.data = data
+        self.tokens = torch.from_numpy(data.tokens.astype(np.int64)).pin_memory().to(device, non_blocking=True)
+
+    @staticmethod
+    def fits_on_device(data: TokenDataset, max_fraction: float=0.25) -> bool:
+        """ Determine if a dataset's tokens are small enough to be stored on the current CUDA device.
+        Arguments:
+        - data: Dataset which would be stored
+        - max_fraction: Largest fraction of the device's free memory the tokens may use
+
+        Returns: True if the tokens fit
+        """
+        (free_bytes, _) = torch.cuda.mem_get_info()
+
+        return data.tokens.size * np.dtype(np.int64).itemsize < max_fraction * free_bytes
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, item: int) -> torch.Tensor:
+        return self.tokens[item:item + self.data.block_size]
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes missing from the DeviceTokenDataset, guard against data itself being missing while unpickling
+        if name == 'data':
+            raise AttributeError(name)
+
+        return getattr(self.data, name)
+
+def use_fused_attention(model: torch.nn.Module) -> int:
+    """ Make a GPT-2 model's self attention layers use torch's scaled_dot_product_attention, which dispatches to fused FlashAttention or memory efficient kernels when they are available. The results match GPT-2's default attention up to floating point rounding.
+    Arguments:
+    - model: GPT-2 model whose attention layers will be modified in place
+
+    Returns: Number of attention layers modified, 0 if the installed transformers version doesn't compute attention in GPT2Attention._attn
+    """
+    # Newer transformers versions don't call GPT2Attention._attn, replacing it there would have no effect
+    try:
+        uses_attn = hasattr(GPT2Attention, '_attn') and 'self._attn(' in inspect.getsource(GPT2Attention.forward)
+    except (OSError, TypeError):
+        uses_attn = False
+
+    if not uses_attn:
+        return 0
+
+    num_modified = 0
+
+    for module in model.modules():
+        if isinstance(module, GPT2Attention) and not module.is_cross_attention:
+            module._attn = partial(fused_attn, module, module._attn)
+            num_modified += 1
+
+    return num_modified
+
+def fused_attn(
+    attention: GPT2Attention,
+    original_attn: Callable[..., Tuple[torch.Tensor, Optional[torch.Tensor]]],
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor]=None,
+    head_mask: Optional[torch.Tensor]=None,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """ Replacement for GPT2Attention._attn which uses scaled_dot_product_attention. Falls back to the original implementation for masked attention and for generation with cached keys, where the causal mask isn't aligned to the top left.
+    Arguments:
+    - attention: Attention layer being run
+    - original_attn: The layer's original _attn method
+    - query, key, value, attention_mask, head_mask: Arguments to GPT2Attention._attn
+
+    Returns: (Attention output, Attention weights), weights are always None unless the original implementation was used
+    """
+    if attention_mask is not None or head_mask is not None or query.size(-2) != key.size(-2):
+        return original_attn(query, key, value, attention_mask, head_mask)
+
+    scale = value.size(-1) ** -0.5 if attention.scale_attn_weights else 1.0
+    if attention.scale_attn_by_inverse_layer_idx:
+        scale /= float(attention.layer_idx + 1)
+
+    attn_output = torch.nn.functional.scaled_dot_product_attention(
+        query,
+        key,
+        value,
+        dropout_p=attention.attn_dropout.p if attention.training else 0.0,
+        is_causal=True,
+        scale=scale,
+    )
+
+    return (attn_output, None)
+
+def save_checkpoint(
+    model: aitextgen,
+    checkpoint_dir: LocalPath,
+    dtype: Optional[torch.dtype]=None,
+):
+    """ Save a model's weights and configuration.
+    Arguments:
+    - model: Model to save
+    - checkpoint_dir: Directory in which the model will be saved
+    - dtype: If not None floating point weights are converted to this type on the host before being saved, the model itself is not modified
+    """
+    # torch.compile wraps the model, save the original module so weight names stay the same
+    hf_model = getattr(model.model, '_orig_mod', model.model)
+    state_dict = None
+
+    if dtype is not None:
+        state_dict = {}
+
+        # Tied weights (ex., the input embeddings and output layer) share memory, convert them once so they still share memory when saved
+        converted = {}
+
+        for name, tensor in hf_model.state_dict().items():
+            key = (tensor.device, tensor.data_ptr(), tensor.shape)
+            if key not in converted:
+                # Convert while copying to the host so no extra device memory is used and the checkpoint doesn't contain device tensors
+                converted[key] = tensor.to('cpu', dtype if tensor.is_floating_point() else tensor.dtype)
+
+            state_dict[name] = converted[key]
+
+    os.makedirs(checkpoint_dir.get_absolute_path(), exist_ok=True)
+
+    # The legacy serialization format writes tensors sequentially instead of as separate zip archive entries, which is faster on slow storage
+    # transformers 4.35+ saves safetensors by default and ignores save_function unless safe serialization is turned off
+    hf_model.save_pretrained(
+        checkpoint_dir.get_absolute_path(),
+        state_dict=state_dict,
+        save_function=partial(torch.save, _use_new_zipfile_serialization=False),
+        safe_serialization=False,
+    )
+
+def replace_adamw(
+    optimizers: Any,
+    optimizer_kwargs: Optional[Dict[str, Any]]=None,
+    lr_lambda: Optional[Callable[[int], float]]=None,
+) -> Any:
+    """ Rebuild the AdamW optimizer returned by aitextgen's configure_optimizers with extra keyword arguments, its learning rate scheduler is rebuilt to match.
+    Arguments:
+    - optimizers: ([Optimizer], [Scheduler]) returned by aitextgen's configure_optimizers, schedulers must be LambdaLR schedulers or Lightning scheduler dicts containing one
+    - optimizer_kwargs: Extra keyword arguments for torch.optim.AdamW
+    - lr_lambda: If not None replaces the scheduler's learning rate multiplier function, which is given the step number
+
+    Returns: ([Optimizer], [Scheduler]) with the new optimizer and scheduler
+    """
+    ([original_optimizer], [original_scheduler]) = optimizers
+
+    optimizer = torch.optim.AdamW(
+        [
+            { 'params': group['params'], 'weight_decay': group['weight_decay'] }
+            for group in original_optimizer.param_groups
+        ],
+        lr=original_optimizer.defaults['lr'],
+        betas=original_optimizer.defaults['betas'],
+        eps=original_optimizer.defaults['eps'],
+        **(optimizer_kwargs or {}),
+    )
+
+    original_lambda_lr = original_scheduler['scheduler'] if isinstance(original_scheduler, dict) else original_scheduler
+    lambda_lr = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda or original_lambda_lr.lr_lambdas)
+
+    if isinstance(original_scheduler, dict):
+        scheduler = {
+            **original_scheduler,
+            'scheduler': lambda_lr,
+        }
+    else:
+        scheduler = lambda_lr
+
+    return ([optimizer], [scheduler])
+
+@contextmanager
+def override_trainer(
+    trainer_kwargs: Dict[str, Any],
+    dataloader_kwargs: Optional[Dict[str, Any]]=None,
+    optimizer_kwargs: Optional[Dict[str, Any]]=None,
+    lr_lambda: Optional[Callable[[int], float]]=None,
+) -> Iterator[None]:
+    """ While the context is active any PyTorch Lightning Trainer which is constructed receives extra keyword arguments. aitextgen builds its Trainer inside aitextgen.train() and only exposes some of the Trainer's options, this allows the rest to be set.
+    Arguments:
+    - trainer_kwargs: Keyword arguments which override the values aitextgen passes to the Trainer, except callbacks which are added to aitextgen's callbacks
+    - dataloader_kwargs: If not None the training DataLoader is replaced by one built with these keyword arguments, batch_size and shuffle are kept from aitextgen
+    - optimizer_kwargs: If not None the AdamW optimizer is rebuilt with these extra keyword arguments, see replace_adamw()
+    - lr_lambda: If not None replaces aitextgen's learning rate schedule, see replace_adamw()
+    """
+    original_trainer = pl.Trainer
+
+    def make_trainer(*args, **kwargs) -> pl.Trainer:
+        """ Construct a Trainer with trainer_kwargs applied.
+        Arguments:
+        - args, kwargs: Arguments aitextgen passed to the Trainer
+
+        Returns: Trainer
+        """
+        for key, value in trainer_kwargs.items():
+            if key == 'callbacks':
+                kwargs['callbacks'] = [*kwargs.get('callbacks', []), *value]
+            else:
+                kwargs[key] = value
+
+        trainer = original_trainer(*args, **kwargs)
+        original_fit = trainer.fit
+
+        def fit(model: pl.LightningModule, *fit_args, **fit_kwargs):
+            """ Replace the model's training DataLoader and optimizer then start training.
+            Arguments:
+            - model: aitextgen's LightningModule, which holds the dataset and batch size
+            - fit_args, fit_kwargs: Passed to Trainer.fit
+            """
+            if dataloader_kwargs is not None:
+                model.train_dataloader = lambda: DataLoader(
+                    model.dataset,
+                    batch_size=model.hparams['batch_size'],
+                    shuffle=True,
+                    **dataloader_kwargs,
+                )
+
+            if optimizer_kwargs is not None or lr_lambda is not None:
+                original_configure_optimizers = model.configure_optimizers
+                model.configure_optimizers = lambda: replace_adamw(original_configure_optimizers(), optimizer_kwargs, lr_lambda)
+
+            return original_fit(model, *fit_args, **fit_kwargs)
+
+        trainer.fit = fit
+
+        return trainer
+
+    pl.Trainer = make_trainer
+
+    try:
+        yield
+    finally:
+        pl.Trainer = original_trainer
@@ -1,14 +1,29 @@
+from __future__ import annotations
+
 import argparse
 import os
 import sys
 import json
+import struct
+import importlib
+import functools
 import threading
-from typing import Tuple
-
-from aitextgen import aitextgen
-from aitextgen.TokenDataset import TokenDataset
-from aitextgen.utils import build_gpt2_config
-from transformers import GPT2Config 
+import asyncio
+from concurrent.futures import Future
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, Union
+
+# PyTorch, aitextgen, and transformers take seconds to import, they are imported where needed so --help and TrainingMetadata stay fast
+if TYPE_CHECKING:
+    from aitextgen.TokenDataset import TokenDataset
+    from transformers import GPT2Config
+
+# orjson parses JSON faster than the standard library, but is optional
+json_loads: Callable[[bytes], Any]
+try:
+    json_loads = importlib.import_module('orjson').loads
+except ImportError:
+    json_loads = json.loads
 
 import lib_logging
 from lib_path import LocalPath
@@ -25,6 +40,12 @@ class TrainingMetadata:
     training_iterations: int
     tokenizer_index: LocalPath
 
+    # Metadata files are a fixed size record: magic bytes, little-endian uint64 training_iterations, NUL padded UTF-8 tokenizer_index
+    # Files which don't start with the magic bytes are JSON files saved by older versions
+    RECORD_MAGIC = b"BRAP"
+    RECORD_PATH_SIZE = 500
+    RECORD_FORMAT = struct.Struct(f"<4sQ{RECORD_PATH_SIZE}s")
+
     def __init__(
         self,
         training_iterations: int,
@@ -39,33 +60,51 @@ class TrainingMetadata:
         self.tokenizer_index = tokenizer_index
 
     def save(self, out_file: LocalPath):
-        """ Save the training metadata to a JSON file.
+        """ Save the training metadata to a file. The file is replaced atomically so an interrupted save never leaves a partially written file.
         Arguments:
-        - out_file: Path to which JSON file will be saved
+        - out_file: Path to which file will be saved
+
+        Raises:
+        - ValueError: If the tokenizer_index path is too long to fit in the file
         """
-        with open(out_file.get_absolute_path(), 'w') as out_f:
-            json.dump(
-                {
-                    'training_iterations': self.training_iterations,
-                    'tokenizer_index': self.tokenizer_index.get_project_relative_path(),
-                },
-                out_f,
-                indent=4,
-            )
+        tokenizer_index = self.tokenizer_index.get_project_relative_path().encode('utf-8')
+        if len(tokenizer_index) > TrainingMetadata.RECORD_PATH_SIZE:
+            raise ValueError(f"Tokenizer index path '{self.tokenizer_index.get_project_relative_path()}' is too long to save in training metadata")
+
+        tmp_path = out_file.get_absolute_path() + ".tmp"
+
+        with open(tmp_path, 'wb') as out_f:
+            out_f.write(TrainingMetadata.RECORD_FORMAT.pack(
+                TrainingMetadata.RECORD_MAGIC,
+                self.training_iterations,
+                tokenizer_index,
+            ))
+
+        os.replace(tmp_path, out_file.get_absolute_path())
 
     @staticmethod
     def load(in_file: LocalPath) -> 'TrainingMetadata':
-        """ Load training metadata from a JSON file.
+        """ Load training metadata from a file, files in the older JSON format are also supported.
         Arguments:
-        - in_file: Path to JSON file which will be loaded
+        - in_file: Path to file which will be loaded
 
         Returns: TrainingMetadata loaded from file
 
         Raises:
         - KeyError: If JSON file doesn't contain value required
         """
-        with open(in_file.get_absolute_path(), 'r') as in_f:
-            data = json.load(in_f)
+        with open(in_file.get_absolute_path(), 'rb') as in_f:
+            record = in_f.read(TrainingMetadata.RECORD_FORMAT.size)
+
+            if record.startswith(TrainingMetadata.RECORD_MAGIC):
+                (_, training_iterations, tokenizer_index) = TrainingMetadata.RECORD_FORMAT.unpack(record)
+
+                return TrainingMetadata(
+                    training_iterations=training_iterations,
+                    tokenizer_index=LocalPath(tokenizer_index.rstrip(b"\0").decode('utf-8')),
+                )
+
+            data = json_loads(record + in_f.read())
 
             return TrainingMetadata(
                 training_iterations=data['training_iterations'],
@@ -137,6 +176,47 @@ def parse_args():
         default=5,
     )
 
+    parser.add_argument(
+        '--compile',
+        help="Compile the model with torch.compile, the first training steps will be slower while the model compiles, defaults to on when supported (PyTorch 2.1+, not Windows)",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--fused-attention',
+        help="Compute attention with torch's scaled_dot_product_attention, which uses FlashAttention kernels when available, defaults to on when supported (PyTorch 2.1+)",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--precision',
+        help="Floating point precision used for training, defaults to bf16 on GPUs which support it, fp16 on other GPUs, and fp32 on CPUs",
+        choices=['fp32', 'fp16', 'bf16'],
+        default=None,
+    )
+
+    parser.add_argument(
+        '--grad-accum',
+        help="Number of batches whose gradients are accumulated into each training step",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--pbar-refresh',
+        help="Number of batches between progress bar updates",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        '--fp16-checkpoints',
+        help="Save checkpoint weights in fp16, which halves their size, the final model is always saved in full precision",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+
     return parser.parse_args()
 
 def main():
@@ -145,15 +225,24 @@ def main():
     
     tokenizer_config = TokenizerConfig.load(args.tokenizer_index)
 
-    # Build dataset
-    (data, config) = load_dataset(
+    # Build dataset, encoding happens in the background while the model is created
+    (data_future, config) = load_dataset(
         tokenizer_config=tokenizer_config,
         dataset=args.dataset,
     )
 
+    if args.gpu:
+        import torch
+
+        # Use TF32 for fp32 matrix multiplications on Ampere+ GPUs, and let cuDNN benchmark kernels since input shapes never change
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+
     # Train
     train(
-        data=data,
+        data_future=data_future,
         output_parent_dir=args.models_dir,
         model_name=args.model_name,
         config=config,
@@ -164,39 +253,64 @@ def main():
         target_epochs=args.target_epochs,
         train_epoch_steps=args.train_epoch_steps,
         checkpoint_every_epochs=args.checkpoint_every_epochs,
+        compile_model=args.compile,
+        fused_attention=args.fused_attention,
+        precision=args.precision,
+        grad_accum=args.grad_accum,
+        pbar_refresh=args.pbar_refresh,
+        fp16_checkpoints=args.fp16_checkpoints,
     )
 
 def load_dataset(
     tokenizer_config: TokenizerConfig,
     dataset: LocalPath,
-) -> Tuple[TokenDataset, GPT2Config]:
+) -> Tuple['Future[TokenDataset]', GPT2Config]:
     """ Encode training dataset and create a GPT-2 configuration which targets the dataset.
     Arguments:
     - tokenizer_config: Parameters of the Tokenizer which should be used to encode dataset
     - dataset: Path to dataset file
 
-    Returns: (Tokenizer dataset, Configuration for a GPT-2 model preset to use the tokenized dataset)
+    Returns: (Future which resolves to the tokenized dataset, Configuration for a GPT-2 model preset to use the tokenized dataset)
     """
-    # Check if encoded cache exists
-    encoded_dataset_path = os.path.splitext(dataset.get_absolute_path())[0] + '.tar.gz'
-    dataset_kwargs = {}
+    from encode_dataset import start_encode_dataset, load_encoded_dataset
 
-    if os.path.exists(encoded_dataset_path):
-        dataset_kwargs['from_cache'] = encoded_dataset_path
-    
-    # Load dataset
-    data = TokenDataset(
-        file_path=dataset.get_absolute_path(),
-        vocab_file=tokenizer_config.vocab_file.get_absolute_path(),
-        merges_file=tokenizer_config.merges_file.get_absolute_path(),
-        #**dataset_kwargs,
+    # Load the encoded dataset from cache if it was encoded by the same tokenizer
+    encoded_dataset = LocalPath(str(Path(dataset.get_project_relative_path()).with_suffix('.tar.gz')))
+    data = load_encoded_dataset(
+        dataset_out=encoded_dataset,
+        tokenizer_config=tokenizer_config,
     )
-    config = build_gpt2_config(vocab_size=tokenizer_config.vocab_size)
 
-    return (data, config)
+    if data is None:
+        data_future = start_encode_dataset(
+            dataset_in=dataset,
+            dataset_out=encoded_dataset,
+            tokenizer_config=tokenizer_config,
+        )
+    else:
+        logger.info("Loaded encoded dataset from '%s'", encoded_dataset.get_project_relative_path())
+
+        data_future = Future()
+        data_future.set_result(data)
+
+    config = build_cached_gpt2_config(vocab_size=tokenizer_config.vocab_size)
+
+    return (data_future, config)
+
+@functools.lru_cache(maxsize=8)
+def build_cached_gpt2_config(vocab_size: int) -> GPT2Config:
+    """ Build a GPT-2 configuration, results are cached so repeated calls in the same process (ex., hyperparameter sweeps) don't rebuild it.
+    Arguments:
+    - vocab_size: Number of words in the tokenizer's vocabulary
+
+    Returns: GPT-2 configuration
+    """
+    from aitextgen.utils import build_gpt2_config
+
+    return build_gpt2_config(vocab_size=vocab_size)
 
 def train(
-    data: TokenDataset,
+    data_future: 'Future[TokenDataset]',
     output_parent_dir: LocalPath,
     model_name: str,
     config: GPT2Config,
@@ -207,10 +321,16 @@ def train(
     target_epochs: int,
     train_epoch_steps: int,
     checkpoint_every_epochs: int,
+    compile_model: Optional[bool],
+    fused_attention: Optional[bool],
+    precision: Optional[str],
+    grad_accum: int,
+    pbar_refresh: int,
+    fp16_checkpoints: bool,
 ):
     """ Train the model.
     Arguments:
-    - data: Training dataset to feed to the model
+    - data_future: Future which resolves to the training dataset to feed to the model
     - output_parent_dir: Directory in which model sub-directories can be found
     - model_name: Name of sub-directory inside output_parent_dir in which model training data will be stored
     - config: AITextGen GPT-2 model configuration to use for training
@@ -219,9 +339,21 @@ def train(
     - gpu: If the model should be trained on a GPU
     - sample_every: How many training iterations should pass between samples being taken from the model being trained
     - target_epochs: The number of epochs of training which should be completed, set to a negative number to train infinitely
-    - train_epoch_steps: The number of training iterations which should be completed in each epoch, this is also the number of steps which will be completed before the logic checks if training should gracefully exit
+    - train_epoch_steps: The number of training iterations which should be completed in each epoch, progress is recorded at the end of each epoch and the learning rate decays linearly to 0 over each epoch
     - checkpoint_every_epochs: The number of epochs which should pass between backups of the model being made in the model directory
+    - compile_model: If the model should be compiled with torch.compile before training, if None the model is compiled when the installed PyTorch supports it
+    - fused_attention: If the model's attention layers should use torch's scaled_dot_product_attention, if None it is used when the installed PyTorch supports it
+    - precision: Floating point precision to train with, one of 'fp32', 'fp16', or 'bf16', if None the best precision for the device is used
+    - grad_accum: Number of batches whose gradients are accumulated into each training step, training iterations count training steps not batches
+    - pbar_refresh: Number of batches between progress bar updates
+    - fp16_checkpoints: If checkpoint weights should be saved in fp16, the final model is saved in full precision regardless
     """
+    import torch
+    import pytorch_lightning as pl
+    from aitextgen import aitextgen
+
+    from lib_training import DeviceTokenDataset, get_adamw_kernel_kwargs, override_trainer, save_checkpoint, supports_fused_attention, supports_torch_compile, use_fused_attention
+
     # Create model
     model = aitextgen(
         tokenizer_file=tokenizer_config.tokenizer_model_overview_file.get_absolute_path(),
@@ -229,6 +361,76 @@ def train(
         to_gpu=gpu,
     )
 
+    # Optimizations which need a newer PyTorch are only used if it is installed
+    if fused_attention is None:
+        fused_attention = supports_fused_attention()
+    elif fused_attention and not supports_fused_attention():
+        logger.warning("Not using scaled_dot_product_attention because it requires PyTorch 2.1+, installed version is %s", torch.__version__)
+        fused_attention = False
+
+    if compile_model is None:
+        compile_model = supports_torch_compile()
+    elif compile_model and not supports_torch_compile():
+        logger.warning("Not compiling model because torch.compile requires PyTorch 2.1+ and is not supported on Windows, installed version is %s", torch.__version__)
+        compile_model = False
+
+    if fused_attention:
+        num_fused_layers = use_fused_attention(model.model)
+
+        if num_fused_layers > 0:
+            logger.info("Using scaled_dot_product_attention in %d attention layers", num_fused_layers)
+        else:
+            logger.warning("Not using scaled_dot_product_attention because the installed transformers version doesn't compute attention in GPT2Attention._attn")
+
+    if compile_model:
+        # Model inputs always have the shape set by the config's block size, so the compiled graph is reused for every step
+        model.model = torch.compile(model.model, mode="reduce-overhead", fullgraph=False)
+
+    # Determine training precision, GPUs with compute capability 8+ (Ampere) support bf16 which doesn't need fp16's loss scaling
+    if precision is None:
+        precision = 'fp32'
+
+        if gpu:
+            precision = 'bf16' if torch.cuda.get_device_capability()[0] >= 8 else 'fp16'
+
+    if precision == 'fp16' and not gpu:
+        logger.warning("fp16 training is only supported on GPUs, training with fp32 precision instead")
+        precision = 'fp32'
+
+    logger.info("Training with %s precision", precision)
+
+    # Precision is set on the Trainer directly, aitextgen's fp16 option also sets an apex AMP level which PyTorch Lightning rejects when apex isn't used
+    trainer_precisions: Dict[str, Union[int, str]] = {
+        'fp32': 32,
+        'fp16': 16,
+        'bf16': 'bf16',
+    }
+    trainer_kwargs: Dict[str, Any] = { 'precision': trainer_precisions[precision] }
+
+    # Wait for the dataset to finish encoding
+    data = data_future.result()
+
+    # Keep small datasets in GPU memory so batches don't need to be copied to the GPU
+    if gpu and DeviceTokenDataset.fits_on_device(data):
+        data = DeviceTokenDataset(data, 'cuda')
+        logger.info("Stored dataset in GPU memory")
+
+        # Worker processes can't share CUDA tensors and GPU memory can't be pinned
+        dataloader_kwargs = {
+            'num_workers': 0,
+            'pin_memory': False,
+        }
+    else:
+        # Keep workers alive and batches queued between steps, pinned batches can be copied to the GPU asynchronously
+        dataloader_kwargs = {
+            'num_workers': max(2, (os.cpu_count() or 1) // 4),
+            'pin_memory': gpu,
+            'persistent_workers': True,
+            'prefetch_factor': 4,
+        }
+
+    optimizer_kwargs = get_adamw_kernel_kwargs(gpu)
+
     def do_training(should_graceful_exit: threading.Event):
         """ Logic which runs training.
         Arguments:
@@ -237,7 +439,9 @@ def train(
 
         # Model storage
         output_dir = output_parent_dir.join([model_name])
-        logger.info(f"Saving model into '{output_dir.get_project_relative_path()}' directory")
+        output_dir_abs = output_dir.get_absolute_path()
+        output_dir_rel = output_dir.get_project_relative_path()
+        logger.info("Saving model into '%s' directory", output_dir_rel)
 
         # Training metadata
         training_meta_path = output_dir.join(["training-metadata.json"])
@@ -250,101 +454,183 @@ def train(
             training_meta = TrainingMetadata.load(training_meta_path)
 
             if training_meta.tokenizer_index != tokenizer_index:
-                logger.warn(f"Training metadata specified a different tokenizer index file than invocation, stored value='{training_meta.tokenizer_index}', current value='{tokenizer_index}'")
+                logger.warning("Training metadata specified a different tokenizer index file than invocation, stored value='%s', current value='%s'", training_meta.tokenizer_index.get_project_relative_path(), tokenizer_index.get_project_relative_path())
                 training_meta.tokenizer_index = tokenizer_index
     
 
         # Do training
+        initial_training_iterations = training_meta.training_iterations
         num_epochs = 0
-        
-        try:
-            num_epochs_since_checkpoint = 0
+        num_epochs_since_checkpoint = 0
 
-            # Loop until the graceful exit flag is set or the number of target epochs is met (If there even is a number of target epochs)
-            while not should_graceful_exit.is_set() and (num_epochs < target_epochs or target_epochs < 0):
-                # Run one epoch of training
-                model.train(
-                    output_dir=output_dir.get_absolute_path(),
-                    train_data=data,
-                    num_workers=1, # Required or else training on GPUs won't work
-                    generate_every=sample_every,
-                    num_steps=train_epoch_steps,
-                    progress_bar_refresh_rate=1
-                )
+        class TrainingManagementCallback(pl.Callback):
+            """ Runs between training batches to record progress, save checkpoints, and stop training if the graceful exit flag is set.
+            """
 
-                # Increment counters
-                num_epochs += 1
-                num_epochs_since_checkpoint += 1
-                training_meta.training_iterations += train_epoch_steps
+            def on_train_batch_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule, outputs, batch, batch_idx: int, unused: int=0):
+                """ Called by PyTorch Lightning after each training batch.
+                Arguments:
+                - trainer: Trainer running the training
+                - pl_module, outputs, batch, batch_idx, unused: Unused
+                """
+                nonlocal num_epochs, num_epochs_since_checkpoint
 
-                logger.info(f"Completed training epoch {num_epochs} resulting in {train_epoch_steps} steps of training, total steps {training_meta.training_iterations}")
-                
-                training_meta.save(training_meta_path)
+                training_meta.training_iterations = initial_training_iterations + trainer.global_step
 
-                # If we should make a checkpoint
-                if num_epochs_since_checkpoint >= checkpoint_every_epochs:
-                    checkpoint_dir = output_dir.join([f"checkpoint-{training_meta.training_iterations}"])
-                    model.save(checkpoint_dir)
-                    
-                    training_meta.save(checkpoint_dir.join(["training-metadata.json"]))
-                    logger.info(f"Model checkpoint saved into '{checkpoint_dir.get_project_relative_path()}' directory")
+                # Every batch of a training step ends with the same global step, so only count each epoch once
+                if trainer.global_step >= (num_epochs + 1) * train_epoch_steps:
+                    num_epochs += 1
+                    num_epochs_since_checkpoint += 1
+
+                    logger.info("Completed training epoch %d resulting in %d steps of training, total steps %d", num_epochs, train_epoch_steps, training_meta.training_iterations)
 
-                    num_epochs_since_checkpoint = 0
-        except Exception as e:
-            logger.error("Failed to train model", e)
+                    # If we should make a checkpoint, training metadata is also saved when training ends
+                    if num_epochs_since_checkpoint >= checkpoint_every_epochs:
+                        checkpoint_dir = output_dir.join([f"checkpoint-{training_meta.training_iterations}"])
+                        save_checkpoint(
+                            model=model,
+                            checkpoint_dir=checkpoint_dir,
+                            dtype=torch.float16 if fp16_checkpoints else None,
+                        )
+
+                        training_meta.save(training_meta_path)
+                        training_meta.save(checkpoint_dir.join(["training-metadata.json"]))
+                        logger.info("Model checkpoint saved into '%s' directory", checkpoint_dir.get_project_relative_path())
+
+                        num_epochs_since_checkpoint = 0
+
+                if should_graceful_exit.is_set():
+                    trainer.should_stop = True
+
+        try:
+            # Train in one call so the Trainer, DataLoader, and compiled model are only set up once
+            # If there is no number of target epochs train until the graceful exit flag is set
+            num_steps = target_epochs * train_epoch_steps if target_epochs >= 0 else sys.maxsize
+
+            def epoch_lr_lambda(step: int) -> float:
+                """ Learning rate multiplier which decays linearly to 0 over each epoch then restarts, the schedule aitextgen used when each epoch was a separate model.train() call.
+                Arguments:
+                - step: Training step number
+
+                Returns: Learning rate multiplier
+                """
+                return 1.0 - (step % train_epoch_steps) / train_epoch_steps
+
+            with override_trainer(
+                trainer_kwargs={
+                    **trainer_kwargs,
+                    'callbacks': [ TrainingManagementCallback() ],
+                },
+                dataloader_kwargs=dataloader_kwargs,
+                optimizer_kwargs=optimizer_kwargs,
+                lr_lambda=epoch_lr_lambda,
+            ):
+                model.train(
+                    output_dir=output_dir_abs,
+                    train_data=data,
+                    num_workers=dataloader_kwargs['num_workers'],
+                    generate_every=sample_every,
+                    num_steps=num_steps,
+                    progress_bar_refresh_rate=pbar_refresh,
+                    gradient_accumulation_steps=grad_accum,
+                )
+        except Exception:
+            logger.exception("Failed to train model")
         finally:
             if should_graceful_exit.is_set():
                 logger.info("Training gracefully shut down")
             
             training_meta.save(training_meta_path)
                     
-            logger.info(f"Completed {num_epochs} epochs of training resulting in {train_epoch_steps * num_epochs} steps of training, total steps {training_meta.training_iterations}")
-            logger.info(f"Model saved into '{output_dir.get_project_relative_path()}' directory")
+            logger.info("Completed %d epochs of training resulting in %d steps of training, total steps %d", num_epochs, training_meta.training_iterations - initial_training_iterations, training_meta.training_iterations)
+            logger.info("Model saved into '%s' directory", output_dir_rel)
 
     # Run training with graceful shutdown
     should_graceful_exit = threading.Event()
-    training_thread = threading.Thread(
-        target=do_training,
-        kwargs={
-            'should_graceful_exit': should_graceful_exit,
-        },
-    )
 
-    def do_management(should_graceful_exit: threading.Event):
-        """ Allow user to gracefully exit the training process.
-        Arguments:
-        - should_graceful_exit: Used to signal the training thread that it should stop
+    async def do_management():
+        """ Run training in a background thread and allow user to gracefully exit the training process. Returns once training has finished.
         """
+        loop = asyncio.get_running_loop()
+        training_task = asyncio.create_task(asyncio.to_thread(do_training, should_graceful_exit))
 
-        logger.info("Type 'quit' to stop training")
-        training_thread.start()
+        stdin_fd = sys.stdin.fileno()
+        input_buffer = bytearray()
 
-        while True:
-            user_input = input().strip()
+        def handle_command(user_input: str):
+            """ Handle a management command from the user.
+            Arguments:
+            - user_input: Line of input from the user
+            """
+            user_input = user_input.strip()
 
             if user_input == 'quit':
                 logger.info("Attempting a graceful shutdown")
                 should_graceful_exit.set()
-                return
+
+                logger.info("Waiting for training to gracefully shut down")
             elif user_input == 'help':
                 logger.info("While the model is training the following management commands are available")
-                logger.info("- quit: At the end of the next training epoch gracefully end training")
+                logger.info("- quit: At the end of the current training step gracefully end training")
             else:
-                logger.info(f"Unrecognized user input command '{user_input}', type 'help' to see valid commands")
+                logger.info("Unrecognized user input command '%s', type 'help' to see valid commands", user_input)
 
-        logger.info("Waiting for training to gracefully shut down")
-        training_thread.join()
+        def handle_input():
+            """ Read from stdin and handle each complete line as a command, called by the event loop when stdin has input.
+            """
+            # Read the file descriptor directly, sys.stdin buffers lines the event loop would never be notified about
+            data = os.read(stdin_fd, 4096)
 
-    management_thread = threading.Thread(
-        target=do_management,
-        kwargs={
-            'should_graceful_exit': should_graceful_exit,
-        },
-    )
-    management_thread.start()
-    
-    training_thread.join()
-    management_thread.join()
+            if data == b'':
+                # Stdin was closed, no more commands can be received
+                loop.remove_reader(stdin_fd)
+
+                if input_buffer:
+                    handle_command(input_buffer.decode('utf-8', errors='replace'))
+                    input_buffer.clear()
+
+                return
+
+            input_buffer.extend(data)
+            *lines, remainder = input_buffer.split(b'\n')
+            input_buffer[:] = remainder
+
+            for line in lines:
+                handle_command(line.decode('utf-8', errors='replace'))
+
+        def read_input_lines():
+            """ Read commands from stdin with blocking reads, used when the event loop can't poll stdin.
+            """
+            while True:
+                try:
+                    user_input = input()
+                except EOFError:
+                    return
+
+                try:
+                    loop.call_soon_threadsafe(handle_command, user_input)
+                except RuntimeError:
+                    # The event loop closed after training finished
+                    return
+
+        reading_stdin = False
+
+        try:
+            loop.add_reader(stdin_fd, handle_input)
+            reading_stdin = True
+        except (OSError, NotImplementedError):
+            # Stdin is a regular file (ex., redirected from a file) which can't be polled, or the event loop doesn't support readers (ex., on Windows)
+            threading.Thread(target=read_input_lines, daemon=True).start()
+
+        logger.info("Type 'quit' to stop training")
+
+        try:
+            await training_task
+        finally:
+            if reading_stdin:
+                loop.remove_reader(stdin_fd)
+
+    asyncio.run(do_management())
 
     logger.info("Done")
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules in src/ import each other by name, like they do when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
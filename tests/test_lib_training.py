@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("aitextgen")
+
+import lib_training
+
+pytestmark = pytest.mark.skipif(not lib_training.supports_fused_attention(), reason="scaled_dot_product_attention requires PyTorch 2.1+")
+
+def make_model() -> torch.nn.Module:
+    """ Returns: Small randomly initialized GPT-2 model without dropout.
+    """
+    torch.manual_seed(0)
+
+    config = transformers.GPT2Config(
+        vocab_size=100,
+        n_positions=32,
+        n_embd=32,
+        n_layer=2,
+        n_head=4,
+        resid_pdrop=0.0,
+        embd_pdrop=0.0,
+        attn_pdrop=0.0,
+    )
+
+    return transformers.GPT2LMHeadModel(config).eval()
+
+def test_fused_attention_matches_default_attention():
+    model = make_model()
+    input_ids = torch.randint(0, 100, (2, 32))
+
+    with torch.no_grad():
+        expected = model(input_ids).logits
+
+        num_modified = lib_training.use_fused_attention(model)
+        if num_modified == 0:
+            pytest.skip("installed transformers version doesn't compute attention in GPT2Attention._attn")
+
+        assert num_modified == 2
+        actual = model(input_ids).logits
+
+    assert torch.max(torch.abs(actual - expected)).item() <= 1e-5
+
+def test_fused_attention_falls_back_for_cached_generation():
+    model = make_model()
+    input_ids = torch.randint(0, 100, (1, 8))
+
+    with torch.no_grad():
+        expected = model.generate(input_ids, max_length=16, do_sample=False)
+
+        lib_training.use_fused_attention(model)
+        actual = model.generate(input_ids, max_length=16, do_sample=False)
+
+    assert torch.equal(actual, expected)